@@ -3,17 +3,104 @@
 
 import sys
 import csv
+import re
 import logging
-import decimal
 import argparse
+from bisect import bisect_left
 from decimal import Decimal
 from datetime import datetime
-from collections import defaultdict
-from typing import List, Dict, Any
+from functools import lru_cache
+from operator import attrgetter
+from collections import defaultdict, deque, namedtuple
+from itertools import islice
+from types import MappingProxyType
+from typing import List, Dict, Any, Set, Mapping
 
-decimal.getcontext().prec = 8
 logger = logging.getLogger(__name__)
 
+# año de 4 cifras, día y mes de 1 o 2 cifras; sólo dígitos ASCII
+_YMD_RE = re.compile(r"(\d{4})-(\d{1,2})-(\d{1,2})", re.ASCII)
+_DMY_RE = re.compile(r"(\d{1,2})/(\d{1,2})/(\d{4})", re.ASCII)
+
+
+@lru_cache(maxsize=4096)
+def _parse_ymd(date: str) -> datetime:
+    """Convierte una fecha `YYYY-MM-DD` sin pasar por `strptime`"""
+    # fromisoformat admite más formatos (horas, 20200110, semanas) desde 3.11:
+    # sólo se usa para fechas `YYYY-MM-DD` completas
+    if len(date) == 10 and date[4] == "-" and date[7] == "-":
+        return datetime.fromisoformat(date)
+
+    # fechas sin ceros a la izquierda, p.ej. 2020-1-5
+    match = _YMD_RE.fullmatch(date)
+    if match is None:
+        raise ValueError(f"Fecha incorrecta, se esperaba YYYY-MM-DD: {date!r}")
+
+    year, month, day = match.groups()
+    return datetime(int(year), int(month), int(day))
+
+
+@lru_cache(maxsize=4096)
+def _parse_dmy(date: str) -> datetime:
+    """Convierte una fecha `DD/MM/YYYY` sin pasar por `strptime`"""
+    match = _DMY_RE.fullmatch(date)
+    if match is None:
+        raise ValueError(f"Fecha incorrecta, se esperaba DD/MM/YYYY: {date!r}")
+
+    day, month, year = match.groups()
+    return datetime(int(year), int(month), int(day))
+
+
+@lru_cache(maxsize=16)
+def _read_prices(prices_file: str) -> Mapping[str, str]:
+    """
+    Lee un archivo de precios en formato ledger-cli y devuelve un índice
+    fecha -> precio con los textos tal cual aparecen, sin convertirlos. Se
+    cachea por archivo, como vista de sólo lectura.
+    """
+    prices = {}
+    with open(prices_file, "r") as f:
+        for line in f:
+            # sólo directivas de precio: descarta comentarios y líneas vacías
+            if line[:1] != "P":
+                continue
+
+            row = line.split()
+            if row[0] == "P":
+                prices[row[1]] = row[3]
+
+    return MappingProxyType(prices)
+
+
+def _date_keys(date: datetime) -> List[str]:
+    """Formas `YYYY-MM-DD` de `date`, con y sin ceros a la izquierda"""
+    return [
+        f"{date.year:04}-{month}-{day}"
+        for month in {f"{date.month:02}", str(date.month)}
+        for day in {f"{date.day:02}", str(date.day)}
+    ]
+
+
+def _select_prices(prices_file: str, dates: Set[datetime] = None) -> Dict[int, Decimal]:
+    """
+    Devuelve los precios de `prices_file` indexados por el ordinal de la
+    fecha, limitados a las fechas de `dates` si se indica. Sólo se convierten
+    a `Decimal` los precios seleccionados.
+    """
+    index = _read_prices(prices_file)
+    if dates is None:
+        # sin la caché de _parse_ymd: las fechas de precios no se repiten
+        parse = _parse_ymd.__wrapped__
+        return {parse(key).toordinal(): Decimal(raw) for key, raw in index.items()}
+
+    prices = {}
+    for date in dates:
+        for key in _date_keys(date):
+            if key in index:
+                prices[date.toordinal()] = Decimal(index[key])
+
+    return prices
+
 
 class Asset:
     """
@@ -33,24 +120,22 @@ class Asset:
         self.kind = kind
         self.prices = {}
 
-    def register_asset_prices(self, prices_file: str):
+    def register_asset_prices(self, prices_file: str, dates: Set[datetime] = None):
+        """
+        Registra los precios indexados por el ordinal de la fecha
+        (`datetime.toordinal()`). Si se indica `dates`, sólo se registran
+        los precios de esas fechas.
+        """
         try:
-            with open(prices_file, "r") as f:
-                """
-                El formato de precios es de ledger-cli
-                """
-                for line in f:
-                    row = line.split()
-                    if row[0] == "P":
-                        self.prices[datetime.strptime(row[1], "%Y-%m-%d")] = Decimal(
-                            row[3]
-                        )
+            self.prices.update(_select_prices(prices_file, dates))
 
         except FileNotFoundError:
             print("Could not find the price file.")
 
 
 class Transaction:
+    __slots__ = ("txid", "date", "type", "qty1", "asset1", "qty2", "asset2")
+
     def __init__(
         self,
         txid: str,
@@ -73,12 +158,28 @@ class Transaction:
     def from_dict(cls, data: Dict[str, Any]) -> "Transaction":
         return cls(
             txid=data["txid"],
-            date=datetime.strptime(data["date"], "%d/%m/%Y"),
-            tx_type=data["type"],
+            date=_parse_dmy(data["date"]),
+            tx_type=sys.intern(data["type"]),
             qty1=Decimal(data["qty1"]),
-            asset1=data["asset1"],
+            asset1=sys.intern(data["asset1"]),
             qty2=Decimal(data["qty2"]),
-            asset2=data["asset2"],
+            asset2=sys.intern(data["asset2"]),
+        )
+
+    @classmethod
+    def from_row(cls, row: List[str], columns: Dict[str, int]) -> "Transaction":
+        """
+        Construye la transacción a partir de una fila de `csv.reader`,
+        con `columns` la posición de cada campo en la cabecera.
+        """
+        return cls(
+            txid=row[columns["txid"]],
+            date=_parse_dmy(row[columns["date"]]),
+            tx_type=sys.intern(row[columns["type"]]),
+            qty1=Decimal(row[columns["qty1"]]),
+            asset1=sys.intern(row[columns["asset1"]]),
+            qty2=Decimal(row[columns["qty2"]]),
+            asset2=sys.intern(row[columns["asset2"]]),
         )
 
     def __repr__(self):
@@ -89,6 +190,8 @@ class Transaction:
 
 
 class Lot:
+    __slots__ = ("date", "asset", "qty", "cost")
+
     def __init__(self, date: datetime, asset: str, qty: Decimal, cost: Decimal):
         self.date = date
         self.asset = asset
@@ -99,7 +202,7 @@ class Lot:
     def from_dict(cls, data: Dict[str, Any]) -> "Lot":
         return cls(
             date=data["date"],
-            asset=data["asset"],
+            asset=sys.intern(data["asset"]),
             qty=data["qty"],
             cost=data["cost"],
         )
@@ -113,9 +216,12 @@ class LotBasket:
     Representa una canasta de lotes de un mismo activo.
     """
 
+    __slots__ = ("asset", "lots", "_total_qty", "_total_cost")
+
     def __init__(self, asset: str, lots: List[Lot] = None):
         self.asset = asset
-        self.lots = lots if lots else list()
+        self.lots = deque(lots) if lots else deque()
+        self._recompute_totals()
 
     def add_lot(self, lot: Lot):
         """Agrega un lote a la canasta."""
@@ -125,30 +231,62 @@ class LotBasket:
             )
 
         self.lots.append(lot)
+        self._total_qty += lot.qty
+        self._total_cost += lot.cost * lot.qty
+
+    def _recompute_totals(self):
+        """Recalcula los totales tras modificar `lots` directamente"""
+        self._total_qty = self._total_cost = 0
+        for lot in self.lots:
+            self._total_qty += lot.qty
+            self._total_cost += lot.cost * lot.qty
+
+    def take(self, qty: Decimal, fifo: bool = True) -> Lot:
+        """
+        Retira hasta `qty` unidades del primer lote (FIFO) o del último (LIFO).
+        Si el lote tiene más de `qty` se parte y se devuelve la parte retirada;
+        si no, se saca el lote entero de la canasta.
+        """
+        lot = self.lots[0] if fifo else self.lots[-1]
+        if lot.qty > qty:
+            lot.qty -= qty
+            taken = Lot(lot.date, lot.asset, qty, lot.cost)
+        else:
+            taken = self.lots.popleft() if fifo else self.lots.pop()
+
+        if self.lots:
+            self._total_qty -= taken.qty
+            self._total_cost -= taken.cost * taken.qty
+        else:
+            # canasta vacía: descarta el residuo de redondeo de los totales
+            self._total_qty = self._total_cost = 0
+
+        return taken
 
     @property
     def total_qty(self) -> Decimal:
         """
         Devuelve la cantidad total
         """
-        return sum(lot.qty for lot in self.lots)
+        return self._total_qty
 
     @property
     def total_cost(self) -> Decimal:
         """
         Devuelve el coste total
         """
-        return sum(lot.cost * lot.qty for lot in self.lots)
+        return self._total_cost
 
     @property
     def avg_cost(self) -> Decimal:
         """
         Devuelve el coste medio por unidad de activo
         """
-        return self.total_cost / self.total_qty if self.total_qty else Decimal(0)
+        total_qty = self._total_qty
+        return self._total_cost / total_qty if total_qty else Decimal(0)
 
     def __repr__(self):
-        return f"LotBasket(asset={self.asset}, lots={self.lots})"
+        return f"LotBasket(asset={self.asset}, lots={list(self.lots)})"
 
 
 class Inventory:
@@ -158,6 +296,7 @@ class Inventory:
     def add_basket(self, basket: LotBasket):
         if basket.asset in self.baskets:
             self.baskets[basket.asset].lots.extend(basket.lots)
+            self.baskets[basket.asset]._recompute_totals()
         else:
             self.baskets[basket.asset] = basket
 
@@ -183,29 +322,37 @@ class Inventory:
         ]
 
     def print_balance(self):
-        output = ""
-        for asset in self.baskets.keys():
-            basket = self.baskets[asset]
-            output += (
-                f"{asset}: ( {basket.total_qty:8.4f} @ {basket.avg_cost:.2f} EUR ) "
-            )
-
-        return output
+        return "".join(
+            f"{asset}: ( {basket.total_qty:8.4f} @ {basket.avg_cost:.2f} EUR ) "
+            for asset, basket in self.baskets.items()
+        )
 
     @staticmethod
     def from_csv(file_path):
         inventory = Inventory()
         with open(file_path, newline="") as csvfile:
-            reader = csv.DictReader(csvfile)
+            reader = csv.reader(csvfile)
+            header = next(reader, None)
+            if header is None:
+                return inventory
+
+            # posición de cada campo, sin espacios alrededor del nombre
+            columns = {name.strip(): i for i, name in enumerate(header)}
+            lot_col = columns["lot"]
+            asset_col = columns["asset"]
+            qty_col = columns["qty"]
+            basis_col = columns["basis"]
+
             for row in reader:
-                # remove white spaces around keys and values
-                row = {k.strip(): v.strip() for k, v in row.items()}
+                if not row:
+                    continue
+
                 try:
-                    date = datetime.strptime(row["lot"].strip(), "%Y-%m-%d")
-                    asset = row["asset"]
-                    qty = Decimal(row["qty"])
-                    avg_cost = Decimal(row["basis"])
-                except ValueError as e:
+                    date = _parse_ymd(row[lot_col].strip())
+                    asset = sys.intern(row[asset_col].strip())
+                    qty = Decimal(row[qty_col].strip())
+                    avg_cost = Decimal(row[basis_col].strip())
+                except (ValueError, IndexError) as e:
                     logger.error(f"Error parsing CSV row: {row}. Exception: {e}")
                     continue
 
@@ -239,6 +386,13 @@ class Inventory:
         return f"Inventory(baskets={self.baskets})"
 
 
+# Resultado de los handlers de transacción
+_HandlerResult = namedtuple(
+    "_HandlerResult",
+    "asset_to_pop qty_to_pop asset_to_push qty_to_push cost_basis income",
+)
+
+
 class TaxEngine:
     def __init__(
         self,
@@ -247,22 +401,35 @@ class TaxEngine:
         initial_inventory: Inventory = None,
         transactions: List[Transaction] = None,
         base_asset: str = "EUR",
+        price_files: Dict[str, str] = None,
+        snapshot_date: datetime = None,
     ):
+        if criterio not in ["FIFO", "LIFO"]:
+            raise ValueError("Criterio must be either FIFO or LIFO")
+
         self.year = year
         self.criterio = criterio
         self.inventory = initial_inventory or Inventory()
-        self.transactions = transactions or []
+        # copia: _init_transactions ordena in situ
+        self.transactions = list(transactions or [])
         self.base_asset = Asset(base_asset, "FIAT")
         self.tax_events = defaultdict(list)
-
-
-        btc = Asset('BTC', 'VIRTUAL')
-        btc.register_asset_prices("/home/tony/contabilidad/trading/precios-btc.db")
-        self.btceur = btc.prices
-
-        xmr = Asset('XMR', 'VIRTUAL')
-        xmr.register_asset_prices("/home/tony/contabilidad/trading/precios-xmr.db")
-        self.xmreur = xmr.prices
+        # Las transacciones anteriores ya están en el inventario inicial
+        self.snapshot_date = snapshot_date
+
+        # Los precios se cargan en _init_transactions, sólo si hay permutas
+        self.price_files = price_files or {}
+        self.btceur = {}
+        self.xmreur = {}
+
+        # Tabla de handlers indexada por tipo y activo de contrapartida
+        self._handlers = {
+            "Buy": {self.base_asset.symbol: self._handle_buy},
+            "Sell": {self.base_asset.symbol: self._handle_sell},
+        }
+        for asset in ["BTC", "XMR"]:
+            self._handlers["Buy"][asset] = self._handle_buy_permuta
+            self._handlers["Sell"][asset] = self._handle_sell_permuta
 
     def read_transactions(self, files: List[str]):
 
@@ -272,81 +439,132 @@ class TaxEngine:
         for transaction_file in files:
             try:
                 with open(transaction_file, "r") as f:
-                    txs.extend(list(csv.DictReader(f, delimiter=";")))
+                    reader = csv.reader(f, delimiter=";")
+                    header = next(reader, None)
+                    if header is None:
+                        continue
+
+                    columns = {name: i for i, name in enumerate(header)}
+                    txs.extend(
+                        Transaction.from_row(row, columns) for row in reader if row
+                    )
             except FileNotFoundError:
                 print(f"Could not find transaction file: {transaction_file}")
                 sys.exit(2)
 
-        # asignar tipos de dato
-        txs = [Transaction.from_dict(tx) for tx in txs]
-
-        # ordenar por fecha
-        self.transactions = sorted(txs, key=lambda tx: tx.date)
+        # se ordenan en _init_transactions
+        self.transactions = txs
 
     def _init_transactions(self):
         """Prepara las transacciones antes de procesarlas"""
         # ordenar por fecha
-        self.transactions = sorted(self.transactions, key=lambda tx: tx.date)
+        self.transactions.sort(key=attrgetter("date"))
+
+        # saltar las transacciones anteriores al inventario inicial
+        self._tx_start = 0
+        if self.snapshot_date is not None:
+            dates = [tx.date for tx in self.transactions]
+            self._tx_start = bisect_left(dates, self.snapshot_date)
+
+        # resolver el handler de cada transacción hasta el año del informe
+        self._tx_handlers = []
+        for tx in islice(self.transactions, self._tx_start, None):
+            if tx.date.year > self.year:
+                break
+
+            try:
+                handler = self._handlers[tx.type][tx.asset2]
+            except KeyError:
+                raise ValueError(
+                    f"Transacción no soportada: {tx.type} {tx.asset1} por {tx.asset2}"
+                ) from None
+            self._tx_handlers.append(handler)
+
+        self._load_prices()
+
+    def _load_prices(self):
+        """Carga los precios de las fechas en que hay permutas"""
+        dates = {
+            tx.date
+            for tx in islice(self.transactions, self._tx_start, None)
+            if tx.asset2 != self.base_asset.symbol and tx.date.year <= self.year
+        }
+        if not dates:
+            return
+
+        for asset in ["BTC", "XMR"]:
+            if self.price_files.get(asset) is None:
+                raise ValueError(f"Falta el archivo de precios de {asset}")
+
+        try:
+            self.btceur = _select_prices(self.price_files["BTC"], dates)
+            self.xmreur = _select_prices(self.price_files["XMR"], dates)
+        except FileNotFoundError as e:
+            raise ValueError(
+                f"No se encuentra el archivo de precios: {e.filename}"
+            ) from None
+
+        # comprobar antes de procesar: un precio ausente dejaría el inventario
+        # a medio actualizar
+        for asset, prices in [("BTC", self.btceur), ("XMR", self.xmreur)]:
+            missing = sorted(date for date in dates if date.toordinal() not in prices)
+            if missing:
+                raise ValueError(
+                    f"Faltan precios de {asset} para: "
+                    + ", ".join(f"{date:%Y-%m-%d}" for date in missing)
+                )
 
     def process_transactions(self):
         logger.info(f"INFORME DE TRANSACCIONES CON MONEDAS VIRTUALES - AÑO {self.year}")
         logger.info(f"Criterio de valoración: {self.criterio}")
         log_inventario_inicial = True
-
-        handlers = {
-            ("Buy", self.base_asset.symbol): self._handle_buy,
-            ("Sell", self.base_asset.symbol): self._handle_sell,
-        }
-
-        handlers.update(
-            {("Buy", asset): self._handle_buy_permuta for asset in ["BTC", "XMR"]}
-        )
-        handlers.update(
-            {("Sell", asset): self._handle_sell_permuta for asset in ["BTC", "XMR"]}
-        )
+        log_info = logger.isEnabledFor(logging.INFO)
 
         self._init_transactions()
-        for n, tx in enumerate(self.transactions):
-            tx_current_year = tx.date.year == self.year
-
-            if tx_current_year and log_inventario_inicial:
+        txs = islice(self.transactions, self._tx_start, None)
+        # _tx_handlers termina en la última transacción de self.year
+        for n, (tx, handler) in enumerate(
+            zip(txs, self._tx_handlers), start=self._tx_start
+        ):
+            tx_year = tx.date.year
+            tx_current_year = tx_year == self.year
+
+            if tx_current_year and log_info and log_inventario_inicial:
                 logger.info(f"Inventario inicial: {self.inventory.print_balance()}")
                 log_inventario_inicial = False
 
-            if tx.date.year <= self.year:
-                handler = handlers.get((tx.type, tx.asset2))
+            (
+                asset_to_pop,
+                qty_to_pop,
+                asset_to_push,
+                qty_to_push,
+                cost_basis,
+                income,
+            ) = handler(tx)
 
-                result = handler(tx)
+            if tx_current_year and log_info:
+                logger.info(
+                    f"\n*** TX {n:3}/{str(tx_year)[2:]} ******************************************************************"
+                )
+                logger.info(
+                    f"{tx.date:%d-%m-%Y} {tx.type:4} {tx.asset1} {tx.qty1:8.4f} @ {cost_basis:8.2f} for {tx.asset2} {tx.qty2:8.2f}"
+                )
 
-                asset_to_pop = result["asset_to_pop"]
-                qty_to_pop = result["qty_to_pop"]
-                asset_to_push = result["asset_to_push"]
-                qty_to_push = result["qty_to_push"]
-                cost_basis = result["cost_basis"]
-                income = result["income"]
+            if asset_to_pop:
+                assign_lot_basket = self.assign_lot(
+                    asset_to_pop, qty_to_pop, log=tx_current_year
+                )
 
-                if tx_current_year:
-                    logger.info(
-                        f"\n*** TX {n:3}/{str(tx.date.year)[2:]} ******************************************************************"
-                    )
-                    logger.info(
-                        f"{tx.date:%d-%m-%Y} {tx.type:4} {tx.asset1} {tx.qty1:8.4f} @ {cost_basis:8.2f} for {tx.asset2} {tx.qty2:8.2f}"
-                    )
+            if asset_to_push:
+                self.record_lot(tx.date, asset_to_push, qty_to_push, cost_basis)
 
-                if asset_to_pop:
-                    assign_lot_basket = self.assign_lot(
-                        asset_to_pop, qty_to_pop, log=tx_current_year
+            if tx_current_year:
+                if income:
+                    self.record_tax_event(
+                        tx.date, tx.asset1, income, assign_lot_basket
                     )
 
-                if asset_to_push:
-                    self.record_lot(tx.date, asset_to_push, qty_to_push, cost_basis)
-
-                if tx_current_year:
-                    if income:
-                        self.record_tax_event(
-                            tx.date, tx.asset1, income, assign_lot_basket
-                        )
-
+                if log_info:
                     logger.info(f"       Inventario: {self.inventory.print_balance()}")
 
     """
@@ -356,29 +574,25 @@ class TaxEngine:
 
     def _handle_buy(self, tx):
 
-        result = {
-            "asset_to_pop": None,
-            "qty_to_pop": None,
-            "asset_to_push": tx.asset1,
-            "qty_to_push": tx.qty1,
-            "cost_basis": tx.qty2 / tx.qty1,
-            "income": None,
-        }
-
-        return result
+        return _HandlerResult(
+            asset_to_pop=None,
+            qty_to_pop=None,
+            asset_to_push=tx.asset1,
+            qty_to_push=tx.qty1,
+            cost_basis=tx.qty2 / tx.qty1,
+            income=None,
+        )
 
     def _handle_sell(self, tx):
 
-        result = {
-            "asset_to_pop": tx.asset1,
-            "qty_to_pop": tx.qty1,
-            "asset_to_push": None,
-            "qty_to_push": None,
-            "cost_basis": tx.qty2 / tx.qty1,
-            "income": tx.qty2,
-        }
-
-        return result
+        return _HandlerResult(
+            asset_to_pop=tx.asset1,
+            qty_to_pop=tx.qty1,
+            asset_to_push=None,
+            qty_to_push=None,
+            cost_basis=tx.qty2 / tx.qty1,
+            income=tx.qty2,
+        )
 
     """
     b) Intercambio de una moneda virtual por otra diferente
@@ -414,19 +628,18 @@ class TaxEngine:
 
         """
 
-        vt = max(self.btceur[tx.date]*tx.qty2,
-                 self.xmreur[tx.date]*tx.qty1)
-
-        result = {
-            "asset_to_pop": tx.asset2,
-            "qty_to_pop": tx.qty2,
-            "asset_to_push": tx.asset1,
-            "qty_to_push": tx.qty1,
-            "cost_basis": vt / tx.qty1,
-            "income": vt
-        }
-
-        return result
+        day = tx.date.toordinal()
+        vt = max(self.btceur[day]*tx.qty2,
+                 self.xmreur[day]*tx.qty1)
+
+        return _HandlerResult(
+            asset_to_pop=tx.asset2,
+            qty_to_pop=tx.qty2,
+            asset_to_push=tx.asset1,
+            qty_to_push=tx.qty1,
+            cost_basis=vt / tx.qty1,
+            income=vt,
+        )
 
     def _handle_sell_permuta(self, tx):
         """
@@ -438,60 +651,43 @@ class TaxEngine:
         GPP = Valor de transmisión - Valor de adquisición
 
         """
-        vt = max(self.btceur[tx.date]*tx.qty2,
-                 self.xmreur[tx.date]*tx.qty1)
-
-        result = {
-            "asset_to_pop": tx.asset1,
-            "qty_to_pop": tx.qty1,
-            "asset_to_push": tx.asset2,
-            "qty_to_push": tx.qty2,
-            "cost_basis": vt / tx.qty2,
-            "income": vt,
-        }
-
-        return result
+        day = tx.date.toordinal()
+        vt = max(self.btceur[day]*tx.qty2,
+                 self.xmreur[day]*tx.qty1)
+
+        return _HandlerResult(
+            asset_to_pop=tx.asset1,
+            qty_to_pop=tx.qty1,
+            asset_to_push=tx.asset2,
+            qty_to_push=tx.qty2,
+            cost_basis=vt / tx.qty2,
+            income=vt,
+        )
 
     def assign_lot(self, asset, qty_to_assign, log=False) -> LotBasket:
 
         remaining_qty = qty_to_assign
+        log = log and logger.isEnabledFor(logging.INFO)
 
-        logger.debug(f"Asset: {asset}\nRemaining qty: {remaining_qty}")
+        logger.debug("Asset: %s\nRemaining qty: %s", asset, remaining_qty)
 
         assigned_lot_basket = LotBasket(asset)
+        basket = self.inventory.baskets[asset]
 
-        while remaining_qty > 0:
-            # Select the first lot from the asset's lot list
-
-            if self.criterio == "FIFO":
-                lot = self.inventory.baskets[asset].lots[0]
-
-            elif self.criterio == "LIFO":
-                lot = self.inventory.baskets[asset].lots[-1]
+        # FIFO consume por el principio de la canasta, LIFO por el final
+        fifo = self.criterio == "FIFO"
 
-            if lot.qty > remaining_qty:
-                # Lot qty more than required, reduce it by qty
-                lot.qty -= remaining_qty
-
-                lot_to_assign = Lot(lot.date, lot.asset, remaining_qty, lot.cost)
-
-                assigned_lot_basket.add_lot(lot_to_assign)
-
-                remaining_qty = 0
-
-            else:
-                # Lot qty less than or equal to required, pop the first lot FIFO, or last LIfO
-                logger.debug(
-                    f"Pop lot: {self.inventory.baskets[asset].lots}\nAsset: {asset}\nRemaining qty: {remaining_qty}"
-                )
-                if self.criterio == "FIFO":
-                    lot_to_assign = self.inventory.baskets[asset].lots.pop(0)
-
-                elif self.criterio == "LIFO":
-                    lot_to_assign = self.inventory.baskets[asset].lots.pop(-1)
+        while remaining_qty > 0:
+            lot_to_assign = basket.take(remaining_qty, fifo)
+            logger.debug(
+                "Take lot: %s\nAsset: %s\nRemaining qty: %s",
+                lot_to_assign,
+                asset,
+                remaining_qty,
+            )
 
-                assigned_lot_basket.add_lot(lot_to_assign)
-                remaining_qty -= lot_to_assign.qty
+            assigned_lot_basket.add_lot(lot_to_assign)
+            remaining_qty -= lot_to_assign.qty
 
             if log:
                 logger.info(
@@ -499,7 +695,9 @@ class TaxEngine:
                 )
 
         logger.debug(
-            f"total- assigned: {assigned_lot_basket.total_qty} --- to assign: {qty_to_assign}"
+            "total- assigned: %s --- to assign: %s",
+            assigned_lot_basket.total_qty,
+            qty_to_assign,
         )
 
         assert assigned_lot_basket.total_qty - qty_to_assign <= 0.000001
@@ -510,26 +708,29 @@ class TaxEngine:
         self, date: datetime, asset: str, qty: Decimal, cost_basis: Decimal
     ) -> None:
 
-        self.inventory.add_lot(Lot(date, asset, qty, cost_basis))
-        logger.debug(f"                  {Lot(date, asset, qty, cost_basis)}")
+        lot = Lot(date, asset, qty, cost_basis)
+        self.inventory.add_lot(lot)
+        logger.debug("                  %s", lot)
 
     def record_tax_event(self, date, asset, income, assigned_lot_basket: LotBasket):
 
         cost = assigned_lot_basket.total_cost
+        result = income - cost
         self.tax_events[asset].append(
             {
                 "date": date,
                 "qty": assigned_lot_basket.total_qty,
                 "income": income,
                 "cost": cost,
-                "result": income - cost,
+                "result": result,
                 "trace": assigned_lot_basket,
             }
         )
 
-        logger.info(
-            f"       V.Transmisión: {income:8.2f} - V.Adquisición: {cost:8.2f} - Ganancia P.: {income-cost:8.2f}"
-        )
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                f"       V.Transmisión: {income:8.2f} - V.Adquisición: {cost:8.2f} - Ganancia P.: {result:8.2f}"
+            )
 
     def year_summary(self):
 
@@ -538,9 +739,13 @@ class TaxEngine:
         logger.info("\n| Activo | V.transmisión | V.adquisición | Ganancia P.")
 
         for asset, events in self.tax_events.items():
-            v_transmision = sum(event["income"] for event in events)
-            v_adquisicion = sum(event["cost"] for event in events)
-            ganancia = sum(event["result"] for event in events)
+            v_transmision = v_adquisicion = 0
+            for event in events:
+                v_transmision += event["income"]
+                v_adquisicion += event["cost"]
+
+            # cada evento cumple result == income - cost
+            ganancia = v_transmision - v_adquisicion
             logger.info(
                 f"|   {asset}  |      {v_transmision:8.2f} |      {v_adquisicion:8.2f} |   {ganancia:8.2f}"
             )
@@ -548,6 +753,14 @@ class TaxEngine:
         return
 
 
+def _snapshot_date(value: str) -> datetime:
+    """Tipo de argparse para `--snapshot_date`"""
+    try:
+        return _parse_ymd(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected YYYY-MM-DD") from None
+
+
 def main():
 
     parser = argparse.ArgumentParser(description="Calculate tax.")
@@ -567,10 +780,30 @@ def main():
         choices=["FIFO", "LIFO"],
         help="Accounting method for tax calculation. Official is FIFO",
     )
-    parser.add_argument("--files", nargs="+", help="List of transaction files")
+    parser.add_argument(
+        "--files", nargs="+", required=True, help="List of transaction files"
+    )
+    parser.add_argument(
+        "--inventory", help="Initial inventory CSV file. Empty if not given"
+    )
+
+    parser.add_argument(
+        "--snapshot_date",
+        type=_snapshot_date,
+        help="Date (YYYY-MM-DD) of the initial inventory, earlier txs are skipped",
+    )
 
     parser.add_argument("--log_file", help="set output log file")
 
+    parser.add_argument(
+        "--btc_prices",
+        help="BTC prices file, in ledger-cli format. Required for permuta txs",
+    )
+    parser.add_argument(
+        "--xmr_prices",
+        help="XMR prices file, in ledger-cli format. Required for permuta txs",
+    )
+
     args = parser.parse_args()
 
     # Set the logging level based on the command line argument
@@ -599,26 +832,23 @@ def main():
         logger.addHandler(fh)
         args = parser.parse_args()
 
-    # files = args.files
-    # initial_inventory = Inventory()
-
-    TXS_BTC_FILE = (
-        # 20
-        "/home/tony/code/cryptotax/data/transactions-bisq.csv"
-    )
-    TXS_XMR_FILE = "/home/tony/code/cryptotax/data/localmonero-2020.csv"
-
-    initial_inventory = Inventory.from_csv(
-        "/home/tony/code/cryptotax/data/inventario-inicial-2020.csv"
-    )
+    initial_inventory = Inventory()
+    if args.inventory:
+        try:
+            initial_inventory = Inventory.from_csv(args.inventory)
+        except FileNotFoundError:
+            print(f"Could not find inventory file: {args.inventory}")
+            sys.exit(2)
 
     tax_report = TaxEngine(
         year=args.year,
         criterio=args.criterio,
         initial_inventory=initial_inventory,
+        price_files={"BTC": args.btc_prices, "XMR": args.xmr_prices},
+        snapshot_date=args.snapshot_date,
     )
 
-    tax_report.read_transactions([TXS_BTC_FILE, TXS_XMR_FILE])
+    tax_report.read_transactions(args.files)
     tax_report.process_transactions()
     tax_report.year_summary()
     tax_report.inventory.to_csv(f"./output/inv_final-{args.year}.csv")
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import argparse
+import logging
 import unittest
 import pytest
 from datetime import datetime
@@ -8,7 +10,8 @@ from csv import DictReader
 from io import StringIO
 from decimal import Decimal
 
-from cryptotax import Lot, LotBasket, Inventory, TaxEngine, Transaction
+from cryptotax import _parse_dmy, _parse_ymd, _read_prices, _snapshot_date
+from cryptotax import Asset, Lot, LotBasket, Inventory, TaxEngine, Transaction
 
 
 def setup_lot():
@@ -73,6 +76,38 @@ def test_lot_basket_avg_cost():
     assert basket.avg_cost == 45
 
 
+def test_lot_basket_totals_after_add_lot():
+    basket, _ = setup_basket()
+    assert basket.total_cost == 450
+    basket.add_lot(Lot(datetime(2020, 1, 10), "XMR", 10, 60))
+    assert basket.total_qty == 20
+    assert basket.total_cost == 1050
+
+
+def test_lot_basket_take():
+    basket, _ = setup_basket()
+    lot = basket.take(2)
+    assert (lot.qty, lot.cost) == (2, 40)
+    assert basket.total_qty == 8
+    assert basket.total_cost == 370
+
+    lot = basket.take(6, fifo=False)
+    assert (lot.qty, lot.cost) == (5, 50)
+    assert [lot.qty for lot in basket.lots] == [3]
+
+
+def test_lot_basket_take_all_resets_totals():
+    basket = LotBasket("XMR")
+    for n in range(1, 8):
+        basket.add_lot(Lot(datetime(2020, 1, n), "XMR", Decimal(n), Decimal(n) / 7))
+
+    while basket.lots:
+        basket.take(Decimal("1.5"))
+
+    assert basket.total_qty == 0
+    assert basket.total_cost == 0
+
+
 def test_inventory_add_basket():
     basket1, basket2 = setup_basket()
     inventory = Inventory()
@@ -81,6 +116,15 @@ def test_inventory_add_basket():
     assert set(inventory.baskets.keys()) == set(["XMR", "BTC"])
 
 
+def test_inventory_add_basket_same_asset():
+    inventory = setup_inventory()
+    inventory.add_basket(
+        LotBasket("XMR", [Lot(datetime(2020, 1, 10), "XMR", 10, 60)])
+    )
+    assert inventory.total_qty("XMR") == 20
+    assert inventory.baskets["XMR"].total_cost == 1050
+
+
 def test_inventory_balance():
     inventory = Inventory()
     basket1, basket2 = setup_basket()
@@ -96,6 +140,35 @@ def test_inventory_balance():
     ]
 
 
+def test_inventory_print_balance():
+    inventory = setup_inventory()
+    assert inventory.print_balance() == (
+        "XMR: (  10.0000 @ 45.00 EUR ) BTC: (   1.0000 @ 10000.00 EUR ) "
+    )
+
+
+def test_inventory_csv_round_trip(tmp_path):
+    inventory_file = tmp_path / "inventario.csv"
+    setup_inventory().to_csv(str(inventory_file))
+
+    inventory = Inventory.from_csv(str(inventory_file))
+    assert inventory.balance == setup_inventory().balance
+    assert inventory.baskets["XMR"].lots[0].date == datetime(2019, 11, 6)
+
+
+def test_inventory_from_csv_skips_invalid_rows(tmp_path):
+    inventory_file = tmp_path / "inventario.csv"
+    inventory_file.write_text(
+        "lot, asset, qty, basis\n"
+        "2019-11-06, XMR, 5, 40\n"
+        "06/11/2019, XMR, 5, 40\n"
+        "2019-12-02, XMR, -1, 50\n"
+        "2019-12-02, XMR\n"
+    )
+    inventory = Inventory.from_csv(str(inventory_file))
+    assert inventory.balance == [{"XMR": {"qty": 5, "basis": 40}}]
+
+
 # Test case for checking the total quantity of XMR and BTC in the inventory
 def test_inventory_total_qty():
     inventory = setup_inventory()
@@ -142,6 +215,33 @@ def setup_tax_engine():
     )
 
 
+def test_read_transactions(tmp_path):
+    transactions_file = tmp_path / "transactions.csv"
+    transactions_file.write_text(
+        "txid;date;type;qty1;asset1;qty2;asset2\n"
+        "tx2;20/02/2020;Sell;10;XMR;900;EUR\n"
+        "\n"
+        "tx1;10/01/2020;Buy;5;XMR;300;EUR\n"
+    )
+    tax_engine = setup_tax_engine()
+    tax_engine.read_transactions([str(transactions_file)])
+    transactions = {tx.txid: tx for tx in tax_engine.transactions}
+    assert set(transactions) == {"tx1", "tx2"}
+
+    tx = transactions["tx1"]
+    assert tx.date == datetime(2020, 1, 10)
+    assert tx.type == "Buy"
+    assert tx.qty1 == Decimal("5")
+    assert tx.asset1 == "XMR"
+    assert tx.qty2 == Decimal("300")
+    assert tx.asset2 == "EUR"
+
+
+def test_tax_engine_wrong_criterio():
+    with pytest.raises(ValueError):
+        TaxEngine(year=2020, criterio="HIFO")
+
+
 # Test case for checking the process_transactions method
 def test_process_transactions():
     tax_engine = setup_tax_engine()
@@ -151,19 +251,263 @@ def test_process_transactions():
     assert len(tax_engine.tax_events) == 1
 
 
+def test_process_transactions_keeps_caller_list():
+    transactions = setup_tax_engine().transactions[::-1]
+    tax_engine = TaxEngine(
+        year=2020, initial_inventory=setup_inventory(), transactions=transactions
+    )
+    tax_engine.process_transactions()
+    assert [tx.txid for tx in transactions] == ["tx2", "tx1"]
+    assert [tx.txid for tx in tax_engine.transactions] == ["tx1", "tx2"]
+
+
+def test_process_transactions_stops_after_year():
+    tax_engine = setup_tax_engine()
+    tax_engine.transactions.append(
+        Transaction(
+            "tx3",
+            datetime(2021, 3, 1),
+            "Buy",
+            Decimal(2.0),
+            "XMR",
+            Decimal(200.0),
+            "EUR",
+        )
+    )
+    tax_engine.process_transactions()
+    assert tax_engine.inventory.total_qty("XMR") == 5
+
+
+def test_process_transactions_snapshot_date():
+    tax_engine = setup_tax_engine()
+    tax_engine.snapshot_date = datetime(2020, 2, 1)
+    tax_engine.process_transactions()
+    # la compra del 10/01 ya está en el inventario inicial
+    assert tax_engine.inventory.total_qty("XMR") == 0
+    assert tax_engine.tax_events["XMR"][0]["cost"] == 450
+
+
+def test_snapshot_date_argument():
+    assert _snapshot_date("2020-02-01") == datetime(2020, 2, 1)
+    for value in ["01/02/2020", "20-02-01", "2020-02-30"]:
+        with pytest.raises(argparse.ArgumentTypeError, match="expected YYYY-MM-DD"):
+            _snapshot_date(value)
+
+
+def test_process_transactions_unsupported():
+    tax_engine = setup_tax_engine()
+    tax_engine.transactions.append(
+        Transaction(
+            "tx3",
+            datetime(2020, 3, 1),
+            "Swap",
+            Decimal(2.0),
+            "XMR",
+            Decimal(200.0),
+            "EUR",
+        )
+    )
+    with pytest.raises(ValueError) as excinfo:
+        tax_engine.process_transactions()
+    assert excinfo.value.__suppress_context__
+
+    # se rechaza antes de modificar el inventario
+    assert tax_engine.inventory.total_qty("XMR") == 10
+
+
 def test_process_transactions_buy():
     """TODO"""
     pass
 
 
-def test_process_transactions_buy_permuta():
-    """TODO"""
-    pass
+def test_process_transactions_buy_permuta(tmp_path):
+    """
+    Compra de 10 XMR entregando 0.5 BTC (coste 5000 EUR)
+    # V. mercado BTC entregados: 0.5 * 16000 = 8000
+    # V. mercado XMR recibidos:  10 * 700    = 7000
+    # V. transmisión: 8000 - Ganancia: 3000
+    """
+    btc_prices = tmp_path / "precios-btc.db"
+    btc_prices.write_text(
+        "P 2020-12-09 BTC 15000 EUR\n"
+        "P 2020-12-10 BTC 16000 EUR\n"
+    )
+    xmr_prices = tmp_path / "precios-xmr.db"
+    xmr_prices.write_text("P 2020-12-10 XMR 700 EUR\n")
+
+    tax_engine = TaxEngine(
+        year=2020,
+        initial_inventory=setup_inventory(),
+        transactions=[
+            Transaction(
+                "tx1",
+                datetime(2020, 12, 10),
+                "Buy",
+                Decimal(10),
+                "XMR",
+                Decimal("0.5"),
+                "BTC",
+            )
+        ],
+        price_files={"BTC": str(btc_prices), "XMR": str(xmr_prices)},
+    )
+    tax_engine.process_transactions()
+
+    # sólo se cargan los precios de las fechas con permutas
+    assert list(tax_engine.btceur) == [datetime(2020, 12, 10).toordinal()]
+    assert tax_engine.inventory.total_qty("BTC") == Decimal("0.5")
+    assert tax_engine.inventory.total_qty("XMR") == 20
+    assert tax_engine.tax_events["XMR"][0]["income"] == 8000
+    assert tax_engine.tax_events["XMR"][0]["result"] == 3000
+
+
+def test_process_transactions_permuta_unpadded_price_dates(tmp_path):
+    btc_prices = tmp_path / "precios-btc.db"
+    btc_prices.write_text("P 2020-12-9 BTC 16000 EUR\n")
+    xmr_prices = tmp_path / "precios-xmr.db"
+    xmr_prices.write_text("P 2020-12-09 XMR 700 EUR\n")
+
+    tax_engine = TaxEngine(
+        year=2020,
+        initial_inventory=setup_inventory(),
+        transactions=[
+            Transaction(
+                "tx1",
+                datetime(2020, 12, 9),
+                "Buy",
+                Decimal(10),
+                "XMR",
+                Decimal("0.5"),
+                "BTC",
+            )
+        ],
+        price_files={"BTC": str(btc_prices), "XMR": str(xmr_prices)},
+    )
+    tax_engine.process_transactions()
+    assert tax_engine.btceur == {datetime(2020, 12, 9).toordinal(): Decimal(16000)}
+    assert tax_engine.tax_events["XMR"][0]["income"] == 8000
+
+
+def test_price_tables_cached_per_file(tmp_path):
+    btc_prices = tmp_path / "precios-btc.db"
+    btc_prices.write_text("P 2020-12-10 BTC 16000 EUR\nP 2021-12-10 BTC 40000 EUR\n")
+    xmr_prices = tmp_path / "precios-xmr.db"
+    xmr_prices.write_text("P 2020-12-10 XMR 700 EUR\nP 2021-12-10 XMR 200 EUR\n")
+    price_files = {"BTC": str(btc_prices), "XMR": str(xmr_prices)}
+
+    hits = _read_prices.cache_info().hits
+    engines = []
+    for year in [2020, 2021]:
+        tax_engine = TaxEngine(
+            year=year,
+            initial_inventory=setup_inventory(),
+            transactions=[
+                Transaction(
+                    "tx1",
+                    datetime(year, 12, 10),
+                    "Buy",
+                    Decimal(1),
+                    "XMR",
+                    Decimal("0.01"),
+                    "BTC",
+                )
+            ],
+            price_files=price_files,
+        )
+        tax_engine._init_transactions()
+        engines.append(tax_engine)
+
+    # el segundo año reutiliza los dos archivos ya leídos
+    assert _read_prices.cache_info().hits - hits == 2
+
+    # cada motor tiene su propia tabla: modificarla no afecta a la caché
+    engines[0].btceur.clear()
+    assert _read_prices(str(btc_prices))["2020-12-10"] == "16000"
+    assert engines[1].btceur == {datetime(2021, 12, 10).toordinal(): Decimal(40000)}
+
+
+def test_process_transactions_permuta_missing_price_date(tmp_path):
+    btc_prices = tmp_path / "precios-btc.db"
+    btc_prices.write_text("P 2020-12-09 BTC 16000 EUR\n")
+    xmr_prices = tmp_path / "precios-xmr.db"
+    xmr_prices.write_text("P 2020-12-10 XMR 700 EUR\n")
+
+    tax_engine = setup_tax_engine()
+    tax_engine.price_files = {"BTC": str(btc_prices), "XMR": str(xmr_prices)}
+    tax_engine.transactions.append(
+        Transaction(
+            "tx3",
+            datetime(2020, 12, 10),
+            "Buy",
+            Decimal(10),
+            "XMR",
+            Decimal("0.5"),
+            "BTC",
+        )
+    )
+    with pytest.raises(ValueError, match="BTC para: 2020-12-10"):
+        tax_engine.process_transactions()
+
+    # se rechaza antes de modificar el inventario
+    assert tax_engine.inventory.total_qty("XMR") == 10
+
+
+def test_process_transactions_permuta_without_prices():
+    tax_engine = TaxEngine(
+        year=2020,
+        initial_inventory=setup_inventory(),
+        transactions=[
+            Transaction(
+                "tx1",
+                datetime(2020, 12, 10),
+                "Sell",
+                Decimal(5),
+                "XMR",
+                Decimal("0.2"),
+                "BTC",
+            )
+        ],
+    )
+    with pytest.raises(ValueError):
+        tax_engine.process_transactions()
+
+
+def test_process_transactions_permuta_price_file_not_found(tmp_path):
+    xmr_prices = tmp_path / "precios-xmr.db"
+    xmr_prices.write_text("P 2020-12-10 XMR 700 EUR\n")
+    missing = str(tmp_path / "precios-btc.db")
+    tax_engine = TaxEngine(
+        year=2020,
+        initial_inventory=setup_inventory(),
+        transactions=[
+            Transaction(
+                "tx1",
+                datetime(2020, 12, 10),
+                "Sell",
+                Decimal(5),
+                "XMR",
+                Decimal("0.2"),
+                "BTC",
+            )
+        ],
+        price_files={"BTC": missing, "XMR": str(xmr_prices)},
+    )
+    with pytest.raises(ValueError, match="precios-btc.db"):
+        tax_engine.process_transactions()
+    assert tax_engine.inventory.total_qty("XMR") == 10
 
 
 def test_process_transactions_sell():
-    """TODO"""
-    pass
+    tax_engine = setup_tax_engine()
+    tx = Transaction(
+        "tx1", datetime(2020, 2, 20), "Sell", Decimal(4), "XMR", Decimal(300), "EUR"
+    )
+    result = tax_engine._handle_sell(tx)
+    assert result.asset_to_pop == "XMR"
+    assert result.qty_to_pop == 4
+    assert result.asset_to_push is None
+    assert result.cost_basis == 75
+    assert result.income == 300
 
 
 def test_process_transactions_sell_permuta():
@@ -206,6 +550,15 @@ def test_record_tax_event():
     assert tax_engine.tax_events["XMR"][0]["result"] == 150
 
 
+def test_year_summary(caplog):
+    caplog.set_level(logging.INFO, logger="cryptotax")
+    tax_engine = setup_tax_engine()
+    tax_engine.process_transactions()
+    caplog.clear()
+    tax_engine.year_summary()
+    assert "|   XMR  |        900.00 |        450.00 |     450.00" in caplog.text
+
+
 # Test case for checking the assign_lot method
 def test_assign_lot():
     tax_engine = setup_tax_engine()
@@ -222,3 +575,65 @@ def test_assign_lot():
     lot_basket = tax_engine.assign_lot("XMR", 10.0)
     assert lot_basket.total_qty == 10.0
     assert lot_basket.total_cost == 450
+
+
+def test_assign_lot_fifo_lifo_order():
+    tax_engine = setup_tax_engine()
+    lot_basket = tax_engine.assign_lot("XMR", 6)
+    assert [lot.cost for lot in lot_basket.lots] == [40, 50]
+    assert [lot.qty for lot in tax_engine.inventory.baskets["XMR"].lots] == [4]
+
+    tax_engine = setup_tax_engine()
+    tax_engine.criterio = "LIFO"
+    lot_basket = tax_engine.assign_lot("XMR", 6)
+    assert [lot.cost for lot in lot_basket.lots] == [50, 40]
+    assert [lot.cost for lot in tax_engine.inventory.baskets["XMR"].lots] == [40]
+
+
+def test_register_asset_prices(tmp_path):
+    prices_file = tmp_path / "precios-btc.db"
+    prices_file.write_text(
+        "; precios BTC\n"
+        "P 2020-01-10 BTC 7200.50 EUR\n"
+        "\n"
+        "P 2020-01-11 BTC 7350.00 EUR\n"
+    )
+    btc = Asset("BTC", "VIRTUAL")
+    btc.register_asset_prices(str(prices_file))
+    assert btc.prices == {
+        datetime(2020, 1, 10).toordinal(): Decimal("7200.50"),
+        datetime(2020, 1, 11).toordinal(): Decimal("7350.00"),
+    }
+
+
+def test_parse_dates():
+    assert _parse_ymd("2020-01-10") == datetime(2020, 1, 10)
+    assert _parse_ymd("2020-1-5") == datetime(2020, 1, 5)
+    assert _parse_dmy("10/01/2020") == datetime(2020, 1, 10)
+    assert _parse_dmy("1/2/2020") == datetime(2020, 2, 1)
+
+    for date in [
+        "10/01/2020",
+        "2020-01-10T12:00",
+        "20200110",
+        "2020-W02-5",
+        "20-1-5",
+        " 2020-1-5",
+        "2020-1-5 ",
+        "2020-1_0-5",
+        "2020-\u0661-5",
+    ]:
+        with pytest.raises(ValueError):
+            _parse_ymd(date)
+
+    for date in [
+        "2020-02-30",
+        "30/02/2020",
+        "15/03/20",
+        " 1/ 2/2020",
+        "10/01/2020 ",
+        "1_0/01/2020",
+        "\u0661\u0660/01/2020",
+    ]:
+        with pytest.raises(ValueError):
+            _parse_dmy(date)